@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Measure the peak memory (RSS) growth and the time taken by
+# xmlmerge.postprocess_xml() on large generated documents, compared to the
+# postprocessing of XML Merge 2.0 that copied the whole tree.  Each
+# measurement runs in a new process.
+#
+# Usage: bench_postprocess.py [N_ITEMS ...]
+#
+# Linux only: the peak RSS is reset through /proc/self/clear_refs right
+# before postprocessing, and read from /proc/self/status (VmHWM) after.
+
+import copy
+import gc
+import subprocess
+import sys
+import time
+
+import lxml.etree as ET
+
+import xmlmerge
+
+
+def postprocess_xml_copying(output_xml):
+    """
+    The postprocess_xml() function of XML Merge 2.0, for comparison.
+    """
+    ns_root = ET.Element("NS_ROOT", nsmap=xmlmerge.xmns)
+    ns_root.append(output_xml)
+    ns_root.remove(output_xml)
+    output_xml = ET.ElementTree(copy.copy(output_xml)).getroot()
+    for el in output_xml.iter():
+        if el.text and not el.text.strip():
+            el.text = None
+        if el.tail and not el.tail.strip():
+            el.tail = None
+    return output_xml
+
+postprocess_functions = {
+    "copying":  postprocess_xml_copying,
+    "in-place": xmlmerge.postprocess_xml,
+}
+
+def build_document(n_items, n_namespaces):
+    """
+    Build a document of n_items <Item/> elements, with n_namespaces
+    (unused) namespaces declared on the root element.
+    """
+    namespaces = "".join(' xmlns:p%d="urn:p%d"' % (i, i)
+                         for i in xrange(n_namespaces))
+    items = "".join('\n  <Item i="%d">\n    <Sub a="x"> </Sub>\n  </Item>' % i
+                    for i in xrange(n_items))
+    return ET.fromstring('<Test xmlns:xm="%s"%s>%s\n</Test>' %
+                         (xmlmerge.xmns["xm"], namespaces, items))
+
+def read_status_kib(name):
+    for line in open("/proc/self/status"):
+        if line.startswith(name + ":"):
+            return int(line.split()[1])
+
+def measure(function_name, n_items, n_namespaces):
+    """
+    measure(function_name, n_items, n_namespaces) -> (int, float)
+
+    Return the peak RSS growth in KiB and the time in seconds taken by
+    postprocessing.
+    """
+    xml = build_document(n_items, n_namespaces)
+    gc.collect()
+    open("/proc/self/clear_refs", "w").write("5")  # reset VmHWM to VmRSS
+    base = read_status_kib("VmRSS")
+    start_time = time.time()
+    postprocess_functions[function_name](xml)
+    seconds = time.time() - start_time
+    return read_status_kib("VmHWM") - base, seconds
+
+def main(argv):
+    if len(argv) == 5 and argv[1] == "--measure":
+        print "%d %f" % measure(argv[2], int(argv[3]), int(argv[4]))
+        return 0
+    n_items_list = [int(a) for a in argv[1:]] or [200000, 500000, 1000000]
+    print "%10s %10s %21s %21s" % ("items", "namespaces",
+                                   "copying", "in-place")
+    for n_items in n_items_list:
+        for n_namespaces in (0, 20):
+            results = []
+            for function_name in ("copying", "in-place"):
+                output = subprocess.Popen(
+                    [sys.executable, __file__, "--measure", function_name,
+                     str(n_items), str(n_namespaces)],
+                    stdout=subprocess.PIPE).communicate()[0]
+                kib, seconds = output.split()
+                results.append("%8d KiB %6.2f s" % (int(kib), float(seconds)))
+            print "%10d %10d %21s %21s" % tuple([n_items, n_namespaces] +
+                                                results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Tests for command line options and APIs of XML Merge that cannot be
+# covered by the tests/*.in.xml / *.ref.xml pairs run by run_tests.sh.
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+import lxml.etree as ET
+
+import xmlmerge
+
+test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests")
+
+
+class XMLMergeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="xmlmerge-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def tmp_path(self, *names):
+        return os.path.join(self.tmp_dir, *names)
+
+    def run_main(self, input_name, *args, **kargs):
+        """
+        Run xmlmerge.main() quietly on tests/<input_name>, and return its
+        result.
+        """
+        argv = ["xmlmerge.py", "-q", "-i", os.path.join(test_dir, input_name)]
+        return xmlmerge.main(argv + list(args), **kargs)
+
+
+class WriteOutputFileTest(XMLMergeTestCase):
+
+    def test_only_if_changed_keeps_mtime(self):
+        output = self.tmp_path("out.xml")
+        self.run_main("0004.var.in.xml", "-o", output)
+        os.utime(output, (1000000000, 1000000000))
+        self.run_main("0004.var.in.xml", "-o", output, "-c")
+        self.assertEqual(os.stat(output).st_mtime, 1000000000)
+        self.run_main("0004.var.in.xml", "-o", output)
+        self.assertNotEqual(os.stat(output).st_mtime, 1000000000)
+
+    def test_only_if_changed_rewrites_changed_output(self):
+        output = self.tmp_path("out.xml")
+        open(output, "wb").write("<Old/>\n")
+        self.run_main("0004.var.in.xml", "-o", output, "-c")
+        self.assertEqual(open(output, "rb").read(),
+                         open(os.path.join(test_dir, "0004.var.ref.xml"),
+                              "rb").read())
+
+    def test_symlink_and_mode(self):
+        os.mkdir(self.tmp_path("real"))
+        target = self.tmp_path("real", "target.xml")
+        link = self.tmp_path("link.xml")
+        open(target, "wb").write("")
+        os.chmod(target, 0755)
+        os.symlink(target, link)
+        self.run_main("0004.var.in.xml", "-o", link)
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(open(target, "rb").read(),
+                         open(os.path.join(test_dir, "0004.var.ref.xml"),
+                              "rb").read())
+        self.assertEqual(stat.S_IMODE(os.stat(target).st_mode), 0755)
+        self.assertEqual(os.listdir(self.tmp_path("real")), ["target.xml"])
+
+    def test_new_file_mode(self):
+        output = self.tmp_path("out.xml")
+        umask = os.umask(022)
+        try:
+            self.run_main("0004.var.in.xml", "-o", output)
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(output).st_mode), 0644)
+
+
+class StatsTest(XMLMergeTestCase):
+
+    def test_stats_api(self):
+        stats = xmlmerge.Stats()
+        self.run_main("0016.include.in.xml", "-o", self.tmp_path("out.xml"),
+                      stats=stats)
+        self.assertEqual(stats.counters["includes"], 5)
+        self.assertEqual(stats.counters["xpath_queries"], 5)
+        self.assertEqual(stats.directives, {"defaultvar": 7, "include": 5,
+                                            "text": 1, "var": 5})
+        self.assertEqual(stats.counters["bytes_written"],
+                         os.path.getsize(self.tmp_path("out.xml")))
+        self.assertEqual(sorted(stats.timings),
+                         ["postprocess", "preprocess", "read", "write"])
+
+    def test_stats_file_json(self):
+        stats_file = self.tmp_path("stats.json")
+        self.run_main("0010.text.in.xml", "-o", self.tmp_path("out.xml"),
+                      "--stats", "json", "--stats-file", stats_file)
+        stats = json.load(open(stats_file))
+        self.assertEqual(sorted(stats), ["counters", "directives", "timings"])
+        self.assertEqual(stats["directives"], {"text": 1, "var": 2})
+
+
+class IncludeTraceTest(XMLMergeTestCase):
+
+    xm_ns = xmlmerge.xmns["xm"]
+
+    def write_files(self, files):
+        for name, content in files.items():
+            open(self.tmp_path(name), "wb").write(content)
+
+    def test_include_map_matches_output(self):
+        # With a default namespace, XPaths are positional (/*/*[n]), so
+        # they are only right if taken from the tree that is written:
+        self.write_files({
+            "in.xml": ('<T xmlns="urn:t" xmlns:xm="%s"><u/>'
+                       '<xm:Include file="frag1.xml" select="/*/*"/>'
+                       '<xm:Include file="frag2.xml" select="/*/*"/>'
+                       '</T>' % self.xm_ns),
+            "frag1.xml": '<F xmlns="urn:t"><v/><w/></F>',
+            "frag2.xml": '<F xmlns="urn:t"><x/><y/></F>',
+        })
+        self.run_main(self.tmp_path("in.xml"), "-o", self.tmp_path("out.xml"),
+                      "-t", "--include-map", self.tmp_path("map.json"))
+        output_xmltree = ET.parse(self.tmp_path("out.xml"))
+        include_map = json.load(open(self.tmp_path("map.json")))
+        self.assertEqual([r["file"] for r in include_map],
+                         ["frag1.xml", "frag2.xml"])
+        tags = []
+        for record in include_map:
+            self.assertEqual(record["via"][0]["file"], "in.xml")
+            for key in ("first", "last"):
+                el, = output_xmltree.xpath(record[key])
+                tags.append(el.tag)
+        self.assertEqual(tags, ["{urn:t}v", "{urn:t}w", "{urn:t}x", "{urn:t}y"])
+
+    def test_removed_range_end_drops_record(self):
+        self.write_files({
+            "in.xml": ('<T xmlns:xm="%s">'
+                       '<xm:Include file="frag.xml" select="/*/*"/>'
+                       '<xm:RemoveElements select="../v"/>'
+                       '</T>' % self.xm_ns),
+            "frag.xml": '<F><v/><w/></F>',
+        })
+        self.run_main(self.tmp_path("in.xml"), "-o", self.tmp_path("out.xml"),
+                      "--include-map", self.tmp_path("map.json"))
+        self.assertEqual(json.load(open(self.tmp_path("map.json"))), [])
+
+    def test_include_line_in_nested_loops(self):
+        self.write_files({
+            "in.xml": ('<T xmlns:xm="%s">\n'
+                       '<xm:Loop i="range(2)">\n'
+                       '<xm:Loop j="range(2)">\n'
+                       '\n'
+                       '<xm:Include file="frag.xml" select="/*/*"/>\n'
+                       '</xm:Loop>\n'
+                       '</xm:Loop>\n'
+                       '</T>' % self.xm_ns),
+            "frag.xml": '<F><v/></F>',
+        })
+        self.run_main(self.tmp_path("in.xml"), "-o", self.tmp_path("out.xml"),
+                      "--include-map", self.tmp_path("map.json"))
+        include_map = json.load(open(self.tmp_path("map.json")))
+        self.assertEqual([r["via"] for r in include_map],
+                         [[{"file": "in.xml", "line": 5}]] * 4)
+
+    def test_preprocess_api(self):
+        input_filename = os.path.join(test_dir, "0022.includetrace.in.xml")
+        xml = xmlmerge.read_input_file(input_filename)
+        stats = xmlmerge.Stats()
+        include_trace = xmlmerge.IncludeTrace()
+        included_filenames = []
+        proc = xmlmerge.XMLPreprocess(stats=stats,
+                                      include_trace=include_trace,
+                                      included_filenames=included_filenames)
+        proc(xml, trace_includes=True, xml_filename=input_filename)
+        self.assertEqual(stats.counters["includes"], 5)
+        self.assertEqual(len(include_trace.records), 5)
+        self.assertEqual([os.path.basename(f) for f in included_filenames],
+                         ["0022.includetrace.fragment.xml"] +
+                         ["0022.includetrace.fragment2.xml"] * 4)
+        records = list(include_trace.iter_records(xml))
+        self.assertEqual([(r[0].tag, r[1].tag) for r in records],
+                         [("B", "C"), ("B", "A"), ("B", "C"),
+                          ("B", "B"), ("B", "B")])
+        self.assertEqual([r[3][-1][1] for r in records], [3, 4, 5, 9, 9])
+
+
+class WatchTest(XMLMergeTestCase):
+
+    def test_file_stat_key(self):
+        filename = self.tmp_path("a.xml")
+        self.assertEqual(xmlmerge.file_stat_key(filename), None)
+        open(filename, "wb").write("<A/>")
+        stat_key = xmlmerge.file_stat_key(filename)
+        self.assertEqual(stat_key[1], 4)
+        open(filename, "wb").write("<AB/>")
+        self.assertNotEqual(xmlmerge.file_stat_key(filename), stat_key)
+
+    def check_file_watcher(self, use_inotify):
+        watcher = xmlmerge.FileWatcher(poll_interval=0.01,
+                                       use_inotify=use_inotify)
+        a, b = self.tmp_path("a.xml"), self.tmp_path("b.xml")
+        open(a, "wb").write("<A/>")
+        stat_keys = {a: xmlmerge.file_stat_key(a), b: None}
+        # Change files while waiting:
+        create_b = lambda: open(b, "wb").write("<B/>")
+        threading.Timer(0.1, create_b).start()
+        self.assertEqual(watcher.wait(stat_keys), [b])
+        stat_keys[b] = xmlmerge.file_stat_key(b)
+        threading.Timer(0.1, os.remove, [a]).start()
+        self.assertEqual(watcher.wait(stat_keys), [a])
+
+    def test_file_watcher_polling(self):
+        self.check_file_watcher(use_inotify=False)
+
+    def test_file_watcher_inotify(self):
+        if xmlmerge.pyinotify is None:
+            self.skipTest("pyinotify not available")
+        self.check_file_watcher(use_inotify=True)
+
+    def test_watch(self):
+        xm_ns = xmlmerge.xmns["xm"]
+        in_xml = ('<T xmlns:xm="%s"><xm:Include file="%%s" select="/*/*"/>'
+                  '</T>' % xm_ns)
+        input, output = self.tmp_path("in.xml"), self.tmp_path("out.xml")
+        a, b = self.tmp_path("a.xml"), self.tmp_path("b.xml")
+        open(input, "wb").write(in_xml % "a.xml")
+        open(a, "wb").write("<F><A/></F>")
+        open(b, "wb").write("<F><B/></F>")
+
+        def change(filename, content):
+            def action():
+                open(filename, "wb").write(content)
+                return [filename]
+            return action
+
+        class FileWatcherStub(object):
+            # Record the watched files and the output, then change a file:
+            def __init__(self, actions):
+                self.actions = actions
+                self.log = []
+            def wait(self, stat_keys):
+                names = sorted(os.path.basename(f) for f in stat_keys)
+                self.log.append((names, open(output, "rb").read()))
+                if not self.actions:
+                    raise KeyboardInterrupt
+                return self.actions.pop(0)()
+
+        watcher = FileWatcherStub([
+            change(a, "<F><A2/></F>"),         # included file changes
+            change(input, in_xml % "b.xml"),   # a.xml no longer included
+            change(b, "<F><B/>"),              # run fails
+            change(b, "<F><B2/></F>"),         # run succeeds again
+        ])
+        stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")  # traceback of the failed run
+        try:
+            options = xmlmerge.parse_command_line(
+                ["xmlmerge.py", "-q", "-i", input, "-o", output])
+            xmlmerge.watch(options, file_watcher=watcher)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual([names for (names, out) in watcher.log],
+                         [["a.xml", "in.xml"], ["a.xml", "in.xml"],
+                          ["b.xml", "in.xml"], ["b.xml", "in.xml"],
+                          ["b.xml", "in.xml"]])
+        self.assertEqual([out.splitlines()[2].strip()
+                          for (names, out) in watcher.log],
+                         ["<A/>", "<A2/>", "<B/>", "<B/>", "<B2/>"])
+
+    def test_xml_schema_cache(self):
+        filename = self.tmp_path("s.xsd")
+        open(filename, "wb").write(
+            '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">' +
+            '<xs:element name="A"/></xs:schema>')
+        xml_schema = xmlmerge.read_xml_schema_file(filename)
+        self.assertTrue(xmlmerge.read_xml_schema_file(filename) is xml_schema)
+        open(filename, "ab").write("\n")
+        self.assertFalse(xmlmerge.read_xml_schema_file(filename) is
+                         xml_schema)
+
+
+if __name__ == "__main__":
+    unittest.main()
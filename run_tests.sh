@@ -16,8 +16,19 @@ echo "${cmd[@]}"
 for f in tests/${1}*.in.xml
 do
     base=${f%.in.xml}
-    cmd=( "$PY" xmlmerge.py -i "$f" -o "$base.out.xml" -r "$base.ref.xml" -d )
+    # Additional options for a test can be given in a "$base.args" file:
+    args=()
+    if [ -f "$base.args" ]
+    then
+        args=( $(cat "$base.args") )
+    fi
+    cmd=( "$PY" xmlmerge.py -i "$f" -o "$base.out.xml" -r "$base.ref.xml" -d
+          "${args[@]}" )
     echo "${cmd[@]}"
     "${cmd[@]}"
     echo
 done
+
+cmd=( "$PY" run_option_tests.py )
+echo "${cmd[@]}"
+"${cmd[@]}"
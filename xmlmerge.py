@@ -45,16 +45,27 @@ __version__ = ".".join(str(n) for n in __version_info__[:2])
 
 ## IMPORTS AND CONSTANTS
 
-import copy
+import hashlib
 import itertools
+import json
 import optparse
 import os
 import re
+import shutil
 import sys
+import tempfile
 import textwrap
+import time
+import traceback
 
 import lxml.etree as ET
 
+# Optional, used by --watch if available:
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
 # Namespace mapping (can be directly used for lxml nsmap arguments):
 xmns = {"xm":   "tag:felixrabe.net,2011:xmlns:xmlmerge:preprocess",
         "xmt":  "tag:felixrabe.net,2011:xmlns:xmlmerge:inctrace"}
@@ -80,9 +91,27 @@ class OptionParser(optparse.OptionParser):
                         help=("only with -r; if output and reference " +
                               "differ, produce a HTML file showing the " +
                               "differences"))
+        self.add_option("-c", "--only-if-changed", action="store_true",
+                        help=("leave the output file untouched (keeping " +
+                              "its modification time) if its content " +
+                              "would not change"))
+        self.add_option("--stats", choices=["text", "json"],
+                        metavar="FORMAT",
+                        help=("print processing statistics to stderr " +
+                              "at the end, FORMAT being 'text' or 'json'"))
+        self.add_option("--stats-file", metavar="FILE",
+                        help=("only with --stats; write the statistics " +
+                              "to FILE instead of stderr"))
         self.add_option("-t", "--trace-includes", action="store_true",
                         help=("add tracing information to included " +
                               "XML fragments"))
+        self.add_option("--include-map", metavar="FILE",
+                        help=("write a JSON map from included output " +
+                              "elements to their source files to FILE"))
+        self.add_option("-w", "--watch", action="store_true",
+                        help=("keep running, and process the input " +
+                              "file again whenever it or any file it " +
+                              "depends on changes"))
         self.add_option("-v", "--verbose", action="store_const",
                         dest="verbose", const=3,
                         help=("show debugging messages"))
@@ -135,7 +164,8 @@ def parse_command_line(argv):
             options.output = options.input      + ".out.xml"
 
     # Convert all filename options to normalized absolutized pathnames:
-    for n in "input output reference".split():
+    for n in ("input output xml_schema reference include_map " +
+              "stats_file").split():
         if getattr(options, n) is None: continue  # if "-r" was not given
         setattr(options, n, os.path.abspath(getattr(options, n)))
 
@@ -170,36 +200,111 @@ def postprocess_xml(output_xml):
     """
     postprocess_xml(output_xml) -> ET._Element
 
-    Remove unnecessary namespace declarations and whitespace. Returns a
-    modified copy of output_xml. The argument may be modified by calling
-    this function.
-    """
-    # Remove unused namespace declarations:
-    # (http://codespeak.net/pipermail/lxml-dev/2009-September/004888.html)
-    ns_root = ET.Element("NS_ROOT", nsmap=xmns)
-    ns_root.append(output_xml)
-    ns_root.remove(output_xml)
-    # If you don't perform this copy, each output_xml element's
-    # getroottree() will report the temporary tree containing the empty
-    # NS_ROOT element. This is not a hack, this is about how lxml works.
-    output_xml = ET.ElementTree(copy.copy(output_xml)).getroot()
-    
-    # Make pretty-printing work by removing unnecessary whitespace:
-    for el in output_xml.iter():
-        if el.text and not el.text.strip():
-            el.text = None
-        if el.tail and not el.tail.strip():
-            el.tail = None
+    Remove unnecessary namespace declarations and whitespace. The argument
+    is modified in-place and returned.
+    """
+    # Make pretty-printing work by removing unnecessary whitespace, and
+    # collect the namespaces declared on the way ("start-ns" events occur
+    # only where namespaces are declared, unlike looking at el.nsmap):
+    namespaces = set()
+    events = ("start", "start-ns", "comment", "pi")
+    for event, obj in ET.iterwalk(output_xml, events=events):
+        if event == "start-ns":
+            namespaces.add(obj)  # (prefix, uri)
+            continue
+        if obj.text and not obj.text.strip():
+            obj.text = None
+        if obj.tail and not obj.tail.strip():
+            obj.tail = None
+
+    # Remove unused XML Merge namespace declarations, but keep all other
+    # namespace declarations, even if unused.  Tracing markers (see
+    # IncludeTrace) get their namespace declared on the root element, if
+    # there are any:
+    keep_ns_prefixes = [prefix for (prefix, uri) in namespaces
+                        if prefix and uri not in xmns.values()]
+    ET.cleanup_namespaces(output_xml, top_nsmap={"xmt": xmns["xmt"]},
+                          keep_ns_prefixes=keep_ns_prefixes)
 
     return output_xml
 
-def write_output_file(output_xml, output_filename):
+def write_output_file(output_xml, output_filename, only_if_changed=False):
     """
+    write_output_file(output_xml, output_filename, only_if_changed=False)
+        -> bool
+
     Write the output XML Element to the specified output filename.
+
+    The output is serialized in memory first and then written to a
+    temporary file in the output directory, which is renamed to
+    output_filename, so the output file is never left half-written.  If
+    output_filename is a symbolic link, the file it points to is written,
+    and an existing output file keeps its permissions.
+
+    If only_if_changed is True and the output file already exists with
+    exactly the same content, it is left untouched, preserving its
+    modification time.
+
+    The result is True if the output file has been written, otherwise the
+    result is False.
+    """
+    # Serialize the root element rather than its tree, leaving out any
+    # DOCTYPE, comments and processing instructions outside of it:
+    output_str = ET.tostring(output_xml, pretty_print=True,
+                             xml_declaration=True, encoding="utf-8")
+    if only_if_changed and file_has_content(output_filename, output_str):
+        return False
+    output_filename = os.path.realpath(output_filename)  # follow symlinks
+    output_dirname = os.path.dirname(output_filename)
+    fd, temp_filename = tempfile.mkstemp(dir=output_dirname,
+                                         prefix=".xmlmerge-")
+    try:
+        temp_file = os.fdopen(fd, "wb")
+        try:
+            temp_file.write(output_str)
+        finally:
+            temp_file.close()
+        # mkstemp() creates the file with mode 0600; use the mode of the
+        # existing output file, or the one a plain open() would have given
+        # a new file:
+        if os.path.exists(output_filename):
+            shutil.copymode(output_filename, temp_filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_filename, 0666 & ~umask)
+        if os.name == "nt" and os.path.exists(output_filename):
+            os.remove(output_filename)  # no atomic replace on Win32
+        os.rename(temp_filename, output_filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    return True
+
+def file_has_content(filename, content_str, chunk_size=65536):
+    """
+    file_has_content(filename, content_str, chunk_size=65536) -> bool
+
+    Check whether the file exists and contains exactly content_str.  The
+    file is compared by size first, then by hashing it chunk by chunk, so
+    it is never read into memory as a whole.
     """
-    output_xmltree = output_xml.getroottree()
-    output_xmltree.write(output_filename, pretty_print=True,
-                         xml_declaration=True, encoding="utf-8")
+    try:
+        if os.path.getsize(filename) != len(content_str):
+            return False
+        f = open(filename, "rb")
+    except (IOError, OSError):
+        return False
+    file_hash = hashlib.sha1()
+    try:
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            file_hash.update(chunk)
+    finally:
+        f.close()
+    return file_hash.digest() == hashlib.sha1(content_str).digest()
+
+_xml_schema_cache = {}  # filename -> (file_stat_key(), ET.XMLSchema)
 
 def read_xml_schema_file(xml_schema_filename):
     """
@@ -207,9 +312,17 @@ def read_xml_schema_file(xml_schema_filename):
 
     Read the XML Schema file, and return the corresponding XML Schema
     object.
+
+    The XML Schema object is reused as long as the file does not change,
+    which saves parsing it again in --watch mode.
     """
+    stat_key = file_stat_key(xml_schema_filename)
+    cached = _xml_schema_cache.get(xml_schema_filename)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
     xml_schema_xmltree = ET.parse(xml_schema_filename)
     xml_schema = ET.XMLSchema(xml_schema_xmltree)
+    _xml_schema_cache[xml_schema_filename] = (stat_key, xml_schema)
     return xml_schema
 
 def match_against_schema(options, output_xml):
@@ -279,6 +392,285 @@ def create_reference_diff_html(html_filename, reference_str, output_str):
     file(html_filename, "w").write(html_str)
 
 
+## PROCESSING STATISTICS
+
+class Stats(object):
+    """
+    Counters and timings collected during one run of XML Merge.
+
+    >>> stats = Stats()
+    >>> proc = XMLPreprocess(stats=stats)
+    >>> stats.count("bytes_read", 1234)
+    >>> xml = stats.timed("postprocess", postprocess_xml, xml)
+    >>> print stats.format_text()
+    """
+
+    counter_names = ("elements", "brace_substitutions", "xpath_queries",
+                     "includes", "bytes_read", "bytes_written")
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.counters = dict((name, 0) for name in self.counter_names)
+        self.directives = {}  # lowercase tag name -> count
+        self.timings = {}  # phase name -> seconds
+
+    def count(self, name, n=1):
+        """
+        Add n to the counter called name.
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_directive(self, tag):
+        """
+        Count one processed <xm:.../> element with the given tag name.
+        """
+        tag = tag.lower()  # tolerate any case, just like XMLPreprocess
+        self.directives[tag] = self.directives.get(tag, 0) + 1
+
+    def timed(self, phase, function, *a, **kw):
+        """
+        timed(phase, function, *a, **kw) -> function(*a, **kw)
+
+        Call function and add the time it took to the timing of phase.
+        """
+        start_time = time.time()
+        try:
+            return function(*a, **kw)
+        finally:
+            self.timings[phase] = (self.timings.get(phase, 0.0) +
+                                   time.time() - start_time)
+
+    def as_dict(self):
+        """
+        as_dict() -> dict
+
+        Return all statistics as a dict of plain dicts.
+        """
+        return {"counters":   dict(self.counters),
+                "directives": dict(self.directives),
+                "timings":    dict(self.timings)}
+
+    def format_json(self):
+        """
+        format_json() -> str
+        """
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def format_text(self):
+        """
+        format_text() -> str
+        """
+        lines = ["Counters:"]
+        for name, n in sorted(self.counters.items()):
+            lines.append("  %-24s %10d" % (name, n))
+        lines.append("Directives:")
+        for tag, n in sorted(self.directives.items()):
+            lines.append("  %-24s %10d" % (tag, n))
+        lines.append("Timings (seconds):")
+        for phase, seconds in sorted(self.timings.items()):
+            lines.append("  %-24s %10.3f" % (phase, seconds))
+        return "\n".join(lines)
+
+
+def write_stats(stats, format, stats_filename=None):
+    """
+    Write the statistics (a Stats object) in the given format ("text" or
+    "json") to the file stats_filename, or to stderr if it is None.
+    """
+    if format == "json":
+        stats_str = stats.format_json()
+    else:
+        stats_str = stats.format_text()
+    if stats_filename is None:
+        print >>sys.stderr, stats_str
+    else:
+        stats_file = open(stats_filename, "w")
+        try:
+            print >>stats_file, stats_str
+        finally:
+            stats_file.close()
+
+
+## INCLUDE TRACING
+
+class IncludeTrace(object):
+    """
+    Side-table recording where included elements come from.
+
+    Each <xm:Include/> adds one record holding the first and the last of
+    the elements it included, the fragment file they come from, and the
+    chain of <xm:Include/> elements (file and line) that led to it.  So
+    tracing costs time and memory per inclusion, not per element.  (For
+    the same reason, the source lines of included elements are not
+    recorded: they may come from fragments included by the fragment.)
+
+    After preprocessing, the records can be written as a JSON map
+    (write_map()) or as <xmt:Begin/> and <xmt:End/> markers around the
+    included elements in the output (insert_markers()).
+
+    As only the first and the last included element are known, a record
+    is dropped if either of them has been removed later on, e.g. by
+    <xm:RemoveElements/>.
+    """
+
+    def __init__(self):
+        super(IncludeTrace, self).__init__()
+        self.records = []  # (first, last, filename, include_chain)
+
+    def add(self, first, last, filename, include_chain):
+        """
+        Record that the elements from first to last (siblings) have been
+        included from filename through include_chain, a tuple of
+        (filename, line) pairs of <xm:Include/> elements.
+        """
+        self.records.append((first, last, filename, include_chain))
+
+    def iter_records(self, output_xml):
+        """
+        Yield those records whose first and last elements are still part
+        of the output_xml element tree, innermost inclusions first.  The
+        other records are silently skipped.
+        """
+        # Removed elements stay in their document, so look at the
+        # ancestors rather than at getroottree():
+        for record in self.records:
+            first, last = record[:2]
+            if (is_within(first, output_xml) and
+                is_within(last, output_xml)):
+                yield record
+
+    def format_filename(self, filename, base_dirname=None):
+        """
+        format_filename(filename, base_dirname=None) -> str
+
+        Return filename relative to base_dirname (if given), using '/' as
+        the path separator.
+        """
+        if base_dirname is not None:
+            filename = os.path.relpath(filename, base_dirname)
+        return filename.replace("\\", "/")
+
+    def insert_markers(self, output_xml, base_dirname=None):
+        """
+        Surround the recorded ranges of included elements in output_xml
+        by <xmt:Begin/> and <xmt:End/> marker elements.  Filenames are
+        given relative to base_dirname, if given.
+        """
+        fmt = self.format_filename
+        # Outermost inclusions first, so markers of inclusions sharing an
+        # element nest properly:
+        for first, last, filename, include_chain in \
+                reversed(list(self.iter_records(output_xml))):
+            filename = fmt(filename, base_dirname)
+            via = " ".join("%s:%s" % (fmt(f, base_dirname), l)
+                           for (f, l) in include_chain)
+            begin = ET.Element("{%s}Begin" % xmns["xmt"], nsmap=xmns,
+                               file=filename, via=via)
+            end = ET.Element("{%s}End" % xmns["xmt"], nsmap=xmns,
+                             file=filename)
+            first.addprevious(begin)
+            last.addnext(end)
+
+    def write_map(self, output_xml, map_filename, base_dirname=None):
+        """
+        Write the recorded ranges of included elements in output_xml as a
+        JSON list to map_filename.  Output elements are given as XPath, so
+        output_xml should be final, i.e. postprocessed and with markers
+        inserted if any.  Filenames are given relative to base_dirname, if
+        given.
+        """
+        fmt = self.format_filename
+        output_xmltree = output_xml.getroottree()
+        include_map = []
+        for first, last, filename, include_chain in \
+                self.iter_records(output_xml):
+            include_map.append({
+                "first": output_xmltree.getpath(first),
+                "last":  output_xmltree.getpath(last),
+                "file":  fmt(filename, base_dirname),
+                "via":   [{"file": fmt(f, base_dirname), "line": l}
+                          for (f, l) in include_chain],
+            })
+        map_file = open(map_filename, "w")
+        try:
+            json.dump(include_map, map_file, indent=2, sort_keys=True)
+        finally:
+            map_file.close()
+
+
+## WATCHING FILES
+
+def file_stat_key(filename):
+    """
+    file_stat_key(filename) -> tuple or None
+
+    Return the modification time and size of the file, or None if the
+    file does not exist.  Used to find out whether a file has changed.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+class FileWatcher(object):
+    """
+    Wait for any of a number of files to change.
+
+    Uses inotify (through the pyinotify module) if available, otherwise
+    polls the files every poll_interval seconds.  Either way, a file is
+    regarded as changed if its file_stat_key() changes.
+
+    >>> watcher = FileWatcher()
+    >>> stat_keys = dict((f, file_stat_key(f)) for f in filenames)
+    >>> changed_filenames = watcher.wait(stat_keys)
+    """
+
+    # inotify events on a directory that may mean a file in it changed:
+    if pyinotify is not None:
+        inotify_mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                        pyinotify.IN_CREATE | pyinotify.IN_DELETE)
+
+    def __init__(self, poll_interval=0.5, use_inotify=True):
+        super(FileWatcher, self).__init__()
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and pyinotify is not None
+
+    def wait(self, stat_keys):
+        """
+        wait(stat_keys) -> list
+
+        Wait until at least one of the files changes, and return the list
+        of changed filenames.  stat_keys maps each filename to watch to its
+        file_stat_key() that is regarded as unchanged.
+        """
+        while True:
+            changed_filenames = [f for (f, stat_key) in
+                                 sorted(stat_keys.items())
+                                 if file_stat_key(f) != stat_key]
+            if changed_filenames:
+                return changed_filenames
+            if self.use_inotify:
+                self._wait_inotify(stat_keys.keys())
+            else:
+                time.sleep(self.poll_interval)
+
+    def _wait_inotify(self, filenames):
+        # Watch the directories, as editors often replace files instead of
+        # writing to them.  Time out now and then, in case an event has
+        # been missed while setting up the watches.
+        watch_manager = pyinotify.WatchManager()
+        for dirname in set(os.path.dirname(f) for f in filenames):
+            if os.path.isdir(dirname):
+                watch_manager.add_watch(dirname, self.inotify_mask)
+        notifier = pyinotify.Notifier(watch_manager, timeout=5000)
+        try:
+            if notifier.check_events():
+                notifier.read_events()
+        finally:
+            notifier.stop()
+
+
 ## VARIOUS FUNCTIONS
 
 def print_xml_error(xml_element, code=None):
@@ -292,9 +684,23 @@ def print_xml_error(xml_element, code=None):
         print >>sys.stderr, "    %s" % code.replace("\n", "\n    ")
 
 
+def is_within(xml_element, xml_root):
+    """
+    is_within(xml_element, xml_root) -> bool
+
+    Check whether xml_element is xml_root or one of its descendants.
+    """
+    while xml_element is not None:
+        if xml_element is xml_root:
+            return True
+        xml_element = xml_element.getparent()
+    return False
+
+
 _brace_substitution_regex = re.compile(r"\{(.*?)\}")
 
-def brace_substitution(string, xml_element=None, namespace=None):
+def brace_substitution(string, xml_element=None, namespace=None,
+                       stats=None):
     """
     Evaluate Python expressions within strings.
 
@@ -306,6 +712,8 @@ def brace_substitution(string, xml_element=None, namespace=None):
 
     Multiple Python expressions in one string are supported as well.  Nested
     Python expressions are not supported.
+
+    If stats is given, each evaluated expression is counted in it.
     """
     if namespace is None: namespace = {}
     new_str = []  # faster than continuously concatenating strings
@@ -322,6 +730,8 @@ def brace_substitution(string, xml_element=None, namespace=None):
             raise
         new_str.append(result)
         last_index = match.end()
+        if stats is not None:
+            stats.count("brace_substitutions")
     new_str.append(string[last_index:])
     return "".join(new_str)
 
@@ -334,11 +744,34 @@ class XMLPreprocess(object):
 
     >>> proc = XMLPreprocess()
     >>> output_xml = proc(options, input_xml)  # input_xml may change
+
+    Statistics about the processing are collected in proc.stats (a Stats
+    object), which can also be passed in to share it with other code.
+    Likewise, included elements are recorded in proc.include_trace (an
+    IncludeTrace object) if trace_includes is True.
+
+    The include_chain is a tuple of (filename, line) pairs of the
+    <xm:Include/> elements that led to the file being processed.
+
+    If a list is given as included_filenames, the names of all files read
+    by <xm:Include/> elements get appended to it.
     """
 
-    def __init__(self, initial_namespace={}):
+    def __init__(self, initial_namespace={}, stats=None,
+                 include_trace=None, include_chain=(),
+                 included_filenames=None):
         super(XMLPreprocess, self).__init__()
         self._namespace_stack = [initial_namespace]
+        if stats is None:
+            stats = Stats()
+        self.stats = stats
+        if include_trace is None:
+            include_trace = IncludeTrace()
+        self.include_trace = include_trace
+        self.include_chain = include_chain
+        if included_filenames is None:
+            included_filenames = []
+        self.included_filenames = included_filenames
     
     def __call__(self, xml_element, namespace=None,
                  trace_includes=False, xml_filename=None):
@@ -352,9 +785,8 @@ class XMLPreprocess(object):
         namespace. This namespace will be used in XML attribute
         substitution.
 
-        If trace_includes is True, the output will contain tags that
-        surround included sections of the file. The xml_filename argument
-        is then required.
+        If trace_includes is True, the ranges of included elements will be
+        recorded in self.include_trace (see IncludeTrace).
 
         Processing tags will recursively call this method (__call__) for
         preprocessing the included file and for recursive inclusion.
@@ -364,13 +796,15 @@ class XMLPreprocess(object):
         self.namespace = self._namespace_stack[-1]
         self.trace_includes = trace_includes
         self.xml_filename = xml_filename
-        
+        self.stats.count("elements")
+
         ns = "{%s}" % xmns["xm"]
         len_ns = len(ns)
 
         # Evaluate Python expressions in the attributes of xml_element:
         for attr_name, attr_value in xml_element.items():  # attr map
-            v = brace_substitution(attr_value, xml_element, self.namespace)
+            v = brace_substitution(attr_value, xml_element, self.namespace,
+                                   self.stats)
             xml_element.set(attr_name, v)
 
         # If xml_element has xmns["xm"] as its namespace, proceed with the
@@ -380,6 +814,7 @@ class XMLPreprocess(object):
             method = "_xm_" + tag.lower()  # tolerate any case
             if not hasattr(self, method):
                 raise Exception, "cannot process <xm:%s/>" % tag
+            self.stats.count_directive(tag)
             getattr(self, method)(xml_element)  # call the method
             # Preserve tail text:
             tail = xml_element.tail
@@ -408,6 +843,13 @@ class XMLPreprocess(object):
             self._namespace_stack.pop()
             self.namespace = self._namespace_stack[-1]
 
+    def _xpath(self, xml_element, xpath):
+        """
+        Evaluate an XPath expression given by the user, counting it.
+        """
+        self.stats.count("xpath_queries")
+        return xml_element.xpath(xpath)
+
     def _xm_addelements(self, xml_element):
         """
         Add subelements to, before, or after the element selected by XPath
@@ -424,7 +866,7 @@ class XMLPreprocess(object):
         assert sum((to is None, before is None, after is None)) == 2
         select = to or before or after
         
-        selected_context_nodes = xml_element.xpath(select)
+        selected_context_nodes = self._xpath(xml_element, select)
         assert len(selected_context_nodes) == 1
         
         context_node = selected_context_nodes[0]
@@ -506,7 +948,10 @@ class XMLPreprocess(object):
         # Always use '/' for normalized tracing information:
         xml_incl_filename = xml_incl_filename.replace("\\", "/")
 
+        self.included_filenames.append(xml_incl_filename)
         xml_incl = ET.parse(xml_incl_filename).getroot()
+        self.stats.count("includes")
+        self.stats.count("bytes_read", os.path.getsize(xml_incl_filename))
 
         # Build the initial namespace from a copy of the current namespace
         # plus the remaining attributes of the <xm:Include/> element:
@@ -521,20 +966,30 @@ class XMLPreprocess(object):
                 raise
 
         # Preprocess the to-be-included file:
-        proc = XMLPreprocess(initial_namespace=initial_namespace)
+        include_chain = (self.include_chain +
+                         ((self.xml_filename, xml_element.sourceline),))
+        proc = XMLPreprocess(initial_namespace=initial_namespace,
+                             stats=self.stats,
+                             include_trace=self.include_trace,
+                             include_chain=include_chain,
+                             included_filenames=self.included_filenames)
         proc(xml_incl, trace_includes=self.trace_includes,
              xml_filename=xml_incl_filename)
 
         # Select elements to include:
         included_elements = []
         if select is not None:
-            included_elements = xml_incl.xpath(select)
+            included_elements = self._xpath(xml_incl, select)
 
         # Include the elements:
         context_node = xml_element
         for inc_elem in included_elements:
             context_node.addnext(inc_elem)
             context_node = inc_elem
+        if self.trace_includes and included_elements:
+            self.include_trace.add(included_elements[0],
+                                   included_elements[-1],
+                                   xml_incl_filename, include_chain)
 
         # Import from included namespace:
         imported_namespace = {}
@@ -579,6 +1034,12 @@ class XMLPreprocess(object):
             # xml_element_copy = copy.copy(xml_element)  # CRASH
             # The following line is the workaround for the preceeding one:
             xml_element_copy = ET.XML(ET.tostring(xml_element))
+            # Line numbers of the copy count from xml_element; make them
+            # refer to the source file again:
+            if xml_element.sourceline is not None:
+                line_offset = xml_element.sourceline - 1
+                for el in xml_element_copy.iter():
+                    el.sourceline += line_offset
             xml_element.addnext(xml_element_copy)  # temporarily
             xml_element.tail = xml_element_copy.tail = tailtext
             self._recurse_into(xml_element_copy)
@@ -620,7 +1081,7 @@ class XMLPreprocess(object):
         """
         attr_name = xml_element.get("name")
         select_xpath = xml_element.get("from") or xml_element.get("select")
-        for xml_element_selected in xml_element.xpath(select_xpath):
+        for xml_element_selected in self._xpath(xml_element, select_xpath):
             # Can't find another way to remove an attribute than by using
             # 'attrib':
             attrib = xml_element_selected.attrib
@@ -633,7 +1094,7 @@ class XMLPreprocess(object):
         """
         select = xml_element.get("select")
         assert select is not None
-        elements = xml_element.xpath(select)
+        elements = self._xpath(xml_element, select)
         for el in elements:
             el.getparent().remove(el)
 
@@ -653,7 +1114,7 @@ class XMLPreprocess(object):
         name    = xml_element.get("name")
         value   = xml_element.get("value")
         assert sum((select is None, name is None, value is None)) == 0
-        elements = xml_element.xpath(select)
+        elements = self._xpath(xml_element, select)
         for el in elements:
             el.set(name, value)
 
@@ -663,7 +1124,8 @@ class XMLPreprocess(object):
         """
         text = xml_element.text
         if text is None: return
-        tail = brace_substitution(text, xml_element, self.namespace)
+        tail = brace_substitution(text, xml_element, self.namespace,
+                                  self.stats)
         tail += xml_element.tail or ""
         xml_element.tail = tail
 
@@ -694,9 +1156,18 @@ def main(argv, **kargs):
     initial_namespace
       Gets passed on as the initial Python namespace to XMLPreprocess().
 
-    After the XML Merge Manual, the code of this function is the first part of
-    XML Merge any new developer should read.  So keep this code as simple as
-    possible if you change it in any way.
+    stats
+      A Stats object, which collects counters and the time spent in each
+      phase of merge().  Written at the end if --stats is given.  With
+      --watch, each run uses a new Stats object instead.
+
+    included_filenames
+      Gets passed on to XMLPreprocess(), which appends the names of all
+      included files to this list.
+
+    After the XML Merge Manual, the code of this function and of merge() is
+    the first part of XML Merge any new developer should read.  So keep this
+    code as simple as possible if you change it in any way.
 
     These are all possible exit status codes returned or raised (using
     SystemExit) by main or the functions it calls:
@@ -710,27 +1181,68 @@ def main(argv, **kargs):
           provided, and all are requested and all fail to match the output
           file:
             return (2 ** N - 1) * 2  # mismatch_bitmap
+        - With --watch, when interrupted (Ctrl-C):
+            return mismatch_bitmap  # of the last run
     """
     # Parse command line to get options:
     options = parse_command_line(argv)
 
+    # If -w: Keep processing the input file whenever something changes:
+    if options.watch:
+        return watch(options, **kargs)
+
+    return merge(options, **kargs)
+
+def merge(options, **kargs):
+    """
+    merge(options, **kargs) -> int
+
+    Process the input file to produce an output file according to the
+    options (as returned by parse_command_line()).  The keyword arguments
+    and the return value are the same as for main().
+    """
+    # Collect statistics in a Stats object, timing each phase:
+    stats = kargs.setdefault("stats", Stats())
+    timed = stats.timed
+
     # Input file => preprocessing => output file:
-    xml = read_input_file(options.input)
+    xml = timed("read", read_input_file, options.input)
+    stats.count("bytes_read", os.path.getsize(options.input))
     proc = XMLPreprocess(**kargs)
-    proc(xml, trace_includes=options.trace_includes,
-         xml_filename=options.input)
-    xml = postprocess_xml(xml)
-    write_output_file(xml, options.output)
+    trace_includes = (options.trace_includes or
+                      options.include_map is not None)
+    timed("preprocess", proc, xml, trace_includes=trace_includes,
+          xml_filename=options.input)
+    # Tracing information refers to files relative to the output file:
+    output_dirname = os.path.dirname(options.output)
+    if options.trace_includes:
+        proc.include_trace.insert_markers(xml, output_dirname)
+    xml = timed("postprocess", postprocess_xml, xml)
+    if options.include_map is not None:
+        proc.include_trace.write_map(xml, options.include_map,
+                                     output_dirname)
+    is_written = timed("write", write_output_file, xml, options.output,
+                       options.only_if_changed)
+    if is_written:
+        stats.count("bytes_written", os.path.getsize(options.output))
+    elif options.verbose >= 3:
+        print "Output unchanged, not rewritten."
 
     # If -s: Compare output to XML Schema file:
     matches_schema = True  # False means: match requested and negative
     if options.xml_schema is not None:
-        matches_schema = match_against_schema(options, xml)
+        matches_schema = timed("schema", match_against_schema, options, xml)
     
     # If -r: Compare output to reference:
     matches_reference = True  # False means: match requested and negative
     if options.reference is not None:
-        matches_reference = match_against_reference(options, xml)
+        matches_reference = timed("reference", match_against_reference,
+                                  options, xml)
+
+    # If --stats: Write the statistics (not to stdout, so they can be
+    # parsed without the messages above):
+    if options.stats is not None:
+        write_stats(stats, options.stats, options.stats_file)
 
     # Calculate and return the mismatch bitmap:
     mismatch_bitmap = 0
@@ -738,6 +1250,62 @@ def main(argv, **kargs):
     mismatch_bitmap |= int(not matches_reference) << 2  # 4 on mismatch
     return mismatch_bitmap
 
+def watch(options, file_watcher=None, **kargs):
+    """
+    watch(options, file_watcher=None, **kargs) -> int
+
+    Call merge() now, and again whenever the input file, a file included
+    by the last run, the XML Schema file or the reference file changes.
+    Errors during a run are printed, and the files are watched anyway.
+
+    The file_watcher (a FileWatcher object by default) is used to wait for
+    changes.  Each run collects statistics in a new Stats object, so any
+    stats keyword argument is not used.
+
+    Runs until interrupted (Ctrl-C), then returns the result of the last
+    successful run.
+    """
+    if file_watcher is None:
+        file_watcher = FileWatcher()
+    base_filenames = [f for f in (options.input, options.xml_schema,
+                                  options.reference) if f is not None]
+    stat_keys = dict((f, file_stat_key(f)) for f in base_filenames)
+    changed_filenames = [options.input]
+    mismatch_bitmap = 0
+    try:
+        while True:
+            # Each run gets its own namespace, statistics and includes:
+            run_kargs = dict(kargs)
+            run_kargs["stats"] = Stats()
+            run_kargs["initial_namespace"] = \
+                dict(kargs.get("initial_namespace", {}))
+            included_filenames = run_kargs["included_filenames"] = []
+
+            start_time = time.time()
+            try:
+                mismatch_bitmap = merge(options, **run_kargs)
+            except Exception:
+                traceback.print_exc()
+            if options.verbose >= 2:
+                print "Processed in %.3f seconds (changed: %s)." % \
+                    (time.time() - start_time, ", ".join(changed_filenames))
+
+            # Files read for the first time during this run are compared
+            # to their state after the run:
+            for f in included_filenames:
+                if f not in stat_keys:
+                    stat_keys[f] = file_stat_key(f)
+            watched_filenames = set(base_filenames + included_filenames)
+            stat_keys = dict((f, stat_key) for (f, stat_key)
+                             in stat_keys.items() if f in watched_filenames)
+
+            changed_filenames = file_watcher.wait(stat_keys)
+            # The state before the next run is the one to compare to:
+            stat_keys = dict((f, file_stat_key(f)) for f in stat_keys)
+    except KeyboardInterrupt:
+        pass
+    return mismatch_bitmap
+
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))